@@ -1,13 +1,27 @@
 # app.py
-from flask import Flask, render_template, request, jsonify, make_response
+from flask import Flask, render_template, request, jsonify, make_response, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+import asyncio
+import functools
+import hashlib
 import io
 import os
-import gc
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
 import gdown
+import orjson
 import joblib
+import fitz  # PyMuPDF
 import pdfplumber
 import numpy as np
-from sentence_transformers import util
+import torch
+import faiss
+import pyarrow as pa
+import pyarrow.feather as feather
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
 import PyPDF2
 from werkzeug.exceptions import RequestEntityTooLarge
 import google.generativeai as genai
@@ -17,98 +31,392 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # -------- CONFIG ----------
+class OrjsonProvider(DefaultJSONProvider):
+    """Serve jsonify() and request.get_json() through orjson (also handles numpy values)."""
+
+    @staticmethod
+    def _options(sort_keys, indent):
+        """orjson flags matching json.dumps' sort_keys/indent; non-str keys are stringified like json does."""
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        option = self._options(kwargs.get("sort_keys", self.sort_keys), kwargs.get("indent"))
+        return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        # same pretty-printing rule as Flask: indented in debug mode unless compact is set
+        indent = self.compact is False or (self.compact is None and self._app.debug)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=self._options(self.sort_keys, indent)) + b"\n",
+            mimetype=self.mimetype
+        )
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 # set max upload size (bytes) — here 10 MB (adjust as needed)
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
 
+# number of similar cases returned by the semantic search
+TOP_K = 5
+# FAISS index over the corpus embeddings, built once and reused across restarts
+EMBEDDINGS_INDEX_PATH = "embeddings.index"
+# raw arrays converted once from the downloaded pickles (no pickle on later starts)
+EMBEDDINGS_NPY_PATH = "embeddings.npy"
+CASES_TABLE_PATH = "cases.arrow"
+# characters of each judgment shown as a search result preview
+PREVIEW_CHARS = 500
+# ONNX export of the sentence encoder and its int8 dynamic quantization target
+# (avx2 runs on any x86-64 host; use avx512_vnni on CPUs that support it)
+ONNX_MODEL_DIR = "model_onnx"
+ONNX_QUANTIZATION = os.environ.get("ONNX_QUANTIZATION", "avx2")
+# marks where the judgment body starts in an uploaded document
+JUDGMENT_RE = re.compile(r'\bJUDGMENT\b', re.IGNORECASE)
+# words per chunk (~256 tokens) and batch size when embedding a document
+EMBED_CHUNK_WORDS = 200
+EMBED_BATCH_SIZE = 128
+# only the leading chunks of a document are embedded; each chunk is also capped
+# in characters so the tokenizer never sees far more than the model's max sequence length
+EMBED_MAX_CHUNKS = 16
+EMBED_CHUNK_CHARS = 2000
+# semantic cache: LSH tables, bits per hash, min cosine for a hit, max cached queries
+LSH_TABLES = 8
+LSH_BITS = 16
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_MAX_ENTRIES = 1024
+# Gemini answer cache: entry lifetime (seconds) and max cached answers
+GEMINI_CACHE_TTL = 24 * 60 * 60
+GEMINI_CACHE_MAX_ENTRIES = 512
+
 # -------- Helpers ----------
-def download_and_load(file_id, local_path):
-    """Download from Google Drive (if not exists) and load pickle file."""
+def download_and_load(file_id, local_path, mmap_mode=None):
+    """
+    Download from Google Drive (if not exists) and load pickle file.
+    With mmap_mode, numpy arrays inside the pickle are memory-mapped instead of read.
+    """
     url = f"https://drive.google.com/uc?id={file_id}"
     if not os.path.exists(local_path):
-        gdown.download(url, local_path, quiet=False)
-    return joblib.load(local_path)
+        write_atomically(local_path, lambda tmp_path: gdown.download(url, tmp_path, quiet=False))
+    return joblib.load(local_path, mmap_mode=mmap_mode)
 
-def read_pdf_from_bytes(file_bytes):
+def write_atomically(path, write):
+    """
+    Create path (a file or directory) by calling write(tmp_path) and renaming the
+    result into place, so an interrupted first run never leaves a truncated artefact.
     """
-    Extract text from PDF bytes without saving to disk.
-    Tries pdfplumber first, falls back to PyPDF2 if needed.
+    tmp_path = f"{path}.tmp"
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    write(tmp_path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+def _save_npy(path, array):
+    # np.save appends ".npy" to bare paths, so hand it an open file
+    with open(path, "wb") as f:
+        np.save(f, array)
+
+def _join_pages(page_texts):
+    """Write non-empty page texts into one buffer, newline separated, without an intermediate list."""
+    buf = io.StringIO()
+    for txt in page_texts:
+        if txt:
+            if buf.tell():
+                buf.write("\n")
+            buf.write(txt)
+    return buf.getvalue()
+
+def read_pdf_from_stream(stream):
     """
-    text_pages = []
+    Extract text from an uploaded PDF stream without saving to disk.
+    Tries PyMuPDF first, then pdfplumber, falls back to PyPDF2 if needed.
+    PyMuPDF works on a bytes copy of the stream, released as soon as it is done;
+    the fallbacks reuse the same stream.
+    """
+    file_bytes = stream.read()
+    try:
+        with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+            text = _join_pages(page.get_text() for page in doc)
+        if text.strip():
+            return text
+    except Exception:
+        pass
+    del file_bytes
+
     try:
-        with pdfplumber.open(io.BytesIO(file_bytes)) as pdf:
-            for page in pdf.pages:
-                txt = page.extract_text()
-                if txt:
-                    text_pages.append(txt)
-        if text_pages:
-            return "\n".join(text_pages)
+        stream.seek(0)
+        with pdfplumber.open(stream) as pdf:
+            text = _join_pages(page.extract_text() for page in pdf.pages)
+        if text:
+            return text
     except Exception:
         pass
 
     # fallback to PyPDF2
     try:
-        reader = PyPDF2.PdfReader(io.BytesIO(file_bytes))
-        for page in reader.pages:
-            txt = page.extract_text()
-            if txt:
-                text_pages.append(txt)
-        return "\n".join(text_pages)
+        stream.seek(0)
+        reader = PyPDF2.PdfReader(stream)
+        return _join_pages(page.extract_text() for page in reader.pages)
     except Exception as e:
         return f"[ERROR] Could not extract PDF text: {e}"
 
-# -------- Global variables for lazy loading ----------
-_models_loaded = False
-_judgment_texts = None
-_model = None
-_case_names = None
-_embeddings = None
-_modellog = None
-
-def load_models():
-    """Load ML models only when needed (lazy loading)"""
-    global _models_loaded, _judgment_texts, _model, _case_names, _embeddings, _modellog
-
-    if _models_loaded:
-        return
+def split_into_chunks(text, max_words=EMBED_CHUNK_WORDS, max_chunks=EMBED_MAX_CHUNKS):
+    """
+    Split the start of text into at most max_chunks windows of max_words words.
+    Words past the last window are never split out, so long documents cost O(budget).
+    """
+    budget = max_words * max_chunks
+    words = text.split(maxsplit=budget)[:budget]
+    return [
+        " ".join(words[i:i + max_words])[:EMBED_CHUNK_CHARS]
+        for i in range(0, len(words), max_words)
+    ]
+
+def embed_document(model, text):
+    """
+    Embed a long document as the mean of its leading chunk embeddings.
+    Chunks are encoded in one batched call, so sentence-transformers can
+    length-sort them and keep padding low.
+    """
+    chunks = split_into_chunks(text) or [text[:EMBED_CHUNK_CHARS]]
+    chunk_embeddings = model.encode(
+        chunks,
+        batch_size=EMBED_BATCH_SIZE,
+        convert_to_tensor=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    )
+    return torch.nn.functional.normalize(chunk_embeddings.mean(dim=0), dim=0)
+
+def semantic_search(model, embeddings, text):
+    """Return (top_results, top_scores) for text, reusing the semantic cache when possible."""
+    query_embedding = embed_document(model, text)
+    cached = semantic_cache_get(query_embedding)
+    if cached is not None:
+        return cached
+    query = query_embedding.detach().cpu().numpy().astype(np.float32).reshape(1, -1)
+    faiss.normalize_L2(query)
+    top_scores, top_results = embeddings.search(query, TOP_K)
+    # FAISS pads with -1 when the corpus has fewer than TOP_K vectors
+    found = top_results[0] >= 0
+    top_results, top_scores = top_results[0][found], top_scores[0][found]
+    semantic_cache_put(query_embedding, top_results, top_scores)
+    return top_results, top_scores
+
+def build_embeddings_index(embeddings):
+    """
+    Build an inner-product FAISS index over L2-normalized corpus embeddings.
+    Vectors are stored with per-dimension 8-bit scalar quantization at a quarter
+    of the float32 size; search is exhaustive over the 8-bit codes, so every case
+    is compared but the cosine scores are approximate.
+    """
+    if isinstance(embeddings, torch.Tensor):
+        embeddings = embeddings.detach().cpu().numpy()
+    # always copy: the input may be a read-only memmap and normalize_L2 works in place
+    embeddings = np.array(embeddings, dtype=np.float32, order="C", copy=True)
+    faiss.normalize_L2(embeddings)
+    index = faiss.IndexScalarQuantizer(
+        embeddings.shape[1], faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+    )
+    index.train(embeddings)
+    index.add(embeddings)
+    return index
+
+def load_embeddings_array():
+    """
+    Memory-map the corpus embeddings from embeddings.npy,
+    converting it once from the downloaded embeddings.pkl.
+    """
+    if not os.path.exists(EMBEDDINGS_NPY_PATH):
+        embeddings = download_and_load("1molCaZLasdsSMqqskRIcHnmnpQWfAupF", "embeddings.pkl", mmap_mode="r")
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().cpu().numpy()
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        write_atomically(EMBEDDINGS_NPY_PATH, lambda tmp_path: _save_npy(tmp_path, embeddings))
+    return np.load(EMBEDDINGS_NPY_PATH, mmap_mode="r")
+
+def load_embeddings_index():
+    """
+    Read the persisted FAISS index, building it from the embeddings array on first run.
+    The 8-bit codes are loaded into RAM (a quarter of the float32 corpus size).
+    """
+    if os.path.exists(EMBEDDINGS_INDEX_PATH):
+        return faiss.read_index(EMBEDDINGS_INDEX_PATH)
+    index = build_embeddings_index(load_embeddings_array())
+    write_atomically(EMBEDDINGS_INDEX_PATH, lambda tmp_path: faiss.write_index(index, tmp_path))
+    return index
 
+def load_case_table():
+    """
+    Memory-map case names, previews and judgment texts from an uncompressed Arrow
+    file, converting it once from the downloaded pickles. Texts stay in the mapped
+    buffers until a row is read, instead of living in RAM as Python strings.
+    """
+    if not os.path.exists(CASES_TABLE_PATH):
+        case_names = download_and_load("1_IZQmTuucallXvQaeLM8P9q0co79_JD6", "case_names.pkl")
+        judgment_texts = download_and_load("1vAA2spJ-AzHhBqs-gl6gL5_wDk22a5VW", "judgment_texts.pkl")
+        table = pa.table({
+            "case_name": pa.array([str(name) for name in case_names], pa.string()),
+            "preview": pa.array([str(text)[:PREVIEW_CHARS] for text in judgment_texts], pa.string()),
+            "judgment_text": pa.array([str(text) for text in judgment_texts], pa.large_string()),
+        })
+        write_atomically(
+            CASES_TABLE_PATH,
+            lambda tmp_path: feather.write_feather(table, tmp_path, compression="uncompressed")
+        )
+    return feather.read_table(CASES_TABLE_PATH, memory_map=True)
+
+def export_onnx_encoder(model_dir):
+    """Save the pickled encoder to model_dir and add its int8-quantized ONNX export."""
+    download_and_load("1-pje6HUuprf19yGIbJQA7MNwPNGqTkF0", "model.pkl").save(model_dir)
+    onnx_model = SentenceTransformer(model_dir, backend="onnx", device="cpu")
+    export_dynamic_quantized_onnx_model(onnx_model, ONNX_QUANTIZATION, model_dir)
+
+def load_encoder():
+    """
+    Load the sentence encoder on onnxruntime with int8 dynamically quantized weights.
+    The pickled PyTorch model is exported and quantized once into ONNX_MODEL_DIR;
+    if the ONNX path fails, the PyTorch model is used as before.
+    """
+    onnx_file = f"onnx/model_qint8_{ONNX_QUANTIZATION}.onnx"
     try:
-        print("[INFO] Loading ML models...")
-        _judgment_texts = download_and_load("1vAA2spJ-AzHhBqs-gl6gL5_wDk22a5VW", "judgment_texts.pkl")
-        _model = download_and_load("1-pje6HUuprf19yGIbJQA7MNwPNGqTkF0", "model.pkl")
-        _case_names = download_and_load("1_IZQmTuucallXvQaeLM8P9q0co79_JD6", "case_names.pkl")
-        _embeddings = download_and_load("1molCaZLasdsSMqqskRIcHnmnpQWfAupF", "embeddings.pkl")
-        _modellog = download_and_load("1XALJYnXhZB9gXdjAgz8y_I852CpYt-eg", "modellog.pkl")
-        _models_loaded = True
-        print("[INFO] All ML models loaded successfully")
+        if not os.path.exists(os.path.join(ONNX_MODEL_DIR, onnx_file)):
+            print("[INFO] Exporting sentence encoder to quantized ONNX...")
+            write_atomically(ONNX_MODEL_DIR, export_onnx_encoder)
+        return SentenceTransformer(
+            ONNX_MODEL_DIR, backend="onnx", device="cpu", model_kwargs={"file_name": onnx_file}
+        )
     except Exception as e:
-        print(f"[ERROR] Failed to load ML models: {str(e)}")
-        raise e
+        print(f"[WARNING] ONNX encoder unavailable, using PyTorch model: {str(e)}")
+        return download_and_load("1-pje6HUuprf19yGIbJQA7MNwPNGqTkF0", "model.pkl")
+
+# -------- Lazy loading ----------
+# each artefact is loaded on first use, so a request only waits for what it touches;
+# first loads (which may download and convert files) are serialized by _load_lock
+_load_lock = threading.RLock()
+
+def load_once(loader):
+    """Cache loader's result, running its first call under _load_lock."""
+    cached = functools.cache(loader)
 
+    @functools.wraps(loader)
+    def getter():
+        if cached.cache_info().currsize:
+            return cached()
+        with _load_lock:
+            return cached()
+
+    getter.cache_info = cached.cache_info
+    return getter
+
+@load_once
+def get_case_table():
+    return load_case_table()
+
+@load_once
 def get_judgment_texts():
-    if not _models_loaded:
-        load_models()
-    return _judgment_texts
+    # Arrow column: judgment_texts[i].as_py() reads a single text on demand
+    return get_case_table().column("judgment_text")
 
+@load_once
 def get_model():
-    if not _models_loaded:
-        load_models()
-    return _model
+    return load_encoder()
 
+@load_once
 def get_case_names():
-    if not _models_loaded:
-        load_models()
-    return _case_names
+    return get_case_table().column("case_name").to_pylist()
+
+@load_once
+def get_previews():
+    return get_case_table().column("preview")
 
+@load_once
 def get_embeddings():
-    if not _models_loaded:
-        load_models()
-    return _embeddings
+    return load_embeddings_index()
 
+@load_once
 def get_modellog():
-    if not _models_loaded:
-        load_models()
-    return _modellog
+    return download_and_load("1XALJYnXhZB9gXdjAgz8y_I852CpYt-eg", "modellog.pkl")
+
+_MODEL_LOADERS = (get_judgment_texts, get_model, get_case_names, get_previews, get_embeddings, get_modellog)
+
+def models_loaded():
+    """True once every artefact has been loaded."""
+    return all(loader.cache_info().currsize for loader in _MODEL_LOADERS)
+
+def load_models():
+    """Load all ML models (each one only once)"""
+    with _load_lock:
+        if models_loaded():
+            return
+        try:
+            print("[INFO] Loading ML models...")
+            for loader in _MODEL_LOADERS:
+                loader()
+            print("[INFO] All ML models loaded successfully")
+        except Exception as e:
+            print(f"[ERROR] Failed to load ML models: {str(e)}")
+            raise e
+
+# -------- Semantic query cache (LSH) ----------
+_cache_lock = threading.Lock()
+_lsh_planes = None
+_lsh_tables = [dict() for _ in range(LSH_TABLES)]
+_cache_entries = OrderedDict()
+_cache_next_id = 0
+
+def _lsh_keys(query_embedding):
+    """Hash a unit-length query into one sign-bit key per LSH table."""
+    global _lsh_planes
+    if _lsh_planes is None:
+        generator = torch.Generator().manual_seed(0)
+        _lsh_planes = torch.randn(LSH_TABLES, query_embedding.shape[0], LSH_BITS, generator=generator)
+    bits = torch.einsum("d,tdb->tb", query_embedding, _lsh_planes) > 0
+    return tuple(tuple(row) for row in bits.tolist())
+
+def semantic_cache_get(query_embedding):
+    """
+    Return cached (top_results, top_scores) for a near-identical earlier query,
+    or None. A bucket hit only counts if the stored query is within the cosine threshold.
+    """
+    query_embedding = query_embedding.detach().to("cpu", torch.float32)
+    with _cache_lock:
+        for table, key in zip(_lsh_tables, _lsh_keys(query_embedding)):
+            entry_id = table.get(key)
+            if entry_id is None:
+                continue
+            vector, _, result = _cache_entries[entry_id]
+            if float(vector @ query_embedding) >= SEMANTIC_CACHE_THRESHOLD:
+                _cache_entries.move_to_end(entry_id)
+                return result
+    return None
+
+def semantic_cache_put(query_embedding, top_results, top_scores):
+    """Store search results for a query, evicting the least recently used entry when full."""
+    global _cache_next_id
+    query_embedding = query_embedding.detach().to("cpu", torch.float32)
+    with _cache_lock:
+        keys = _lsh_keys(query_embedding)
+        entry_id = _cache_next_id
+        _cache_next_id += 1
+        _cache_entries[entry_id] = (query_embedding, keys, (top_results, top_scores))
+        for table, key in zip(_lsh_tables, keys):
+            table[key] = entry_id
+
+        if len(_cache_entries) > SEMANTIC_CACHE_MAX_ENTRIES:
+            old_id, (_, old_keys, _) = _cache_entries.popitem(last=False)
+            for table, key in zip(_lsh_tables, old_keys):
+                if table.get(key) == old_id:
+                    del table[key]
 
 # -------- Initialize Gemini AI (lazy loading) ----------
 _gemini_initialized = False
@@ -156,51 +464,9 @@ def get_gemini_model():
         initialize_gemini()
     return _gemini_model
 
-def get_legal_explanation(question, context_chunks, max_retries=3):
-    """
-    Get legal explanation from Gemini AI using retrieved context.
-    """
-    gemini_model = get_gemini_model()
-    if not gemini_model:
-        return {
-            "error": "❌ AI service temporarily unavailable due to quota limits. Please try again later or use the search functionality to find relevant legal cases.",
-            "answer": None,
-            "sources": []
-        }
-
-    # Check if we have context, if not provide a helpful response
-    if not context_chunks or len(context_chunks) == 0:
-        return {
-            "error": None,
-            "answer": "I can help explain legal concepts in simple terms, but I need some context from legal cases to provide accurate information. Please use the main search form first to find relevant cases, then ask me specific questions about them.",
-            "sources": []
-        }
-
-    # Build context from chunks
-    context = "\n\n".join([
-        f"[Source: {chunk.get('case', 'Unknown Case')}] {chunk.get('full_text', chunk.get('preview', ''))[:1000]}"
-        for chunk in context_chunks
-    ])
-
-    # Detect question type for appropriate prompt
-    question_lower = question.lower()
-
-    # Check if user wants structured summary
-    wants_structured = any(keyword in question_lower for keyword in [
-        'structured summary', 'summary with sections', 'give a structured summary',
-        'case background', 'high court', 'supreme court', 'why it matters'
-    ])
-
-    # Check if user wants layman's explanation
-    wants_layman = any(keyword in question_lower for keyword in [
-        'explain in simple terms', 'layman', 'non-law student', 'simple words',
-        'easy explanation', 'plain english', 'everyday language'
-    ])
-
-    # Choose appropriate prompt based on question type
-    if wants_structured:
-        # 🔹 Prompt 3 – Structured Summary
-        system_prompt = """You are a senior legal professional and expert in Indian law.
+# -------- Prompt templates ----------
+# 🔹 Prompt 3 – Structured Summary
+STRUCTURED_PROMPT = """You are a senior legal professional and expert in Indian law.
         Your task is to provide a structured summary of this PDF judgment that DIRECTLY ANSWERS the user's specific question.
 
         CRITICAL: Focus on answering what the user specifically asked about, not giving a generic summary.
@@ -236,9 +502,8 @@ def get_legal_explanation(question, context_chunks, max_retries=3):
 
         Please provide a structured answer to their specific question:"""
 
-    elif wants_layman:
-        # 🔹 Prompt 4 – Layman's Understanding
-        system_prompt = """You are a senior legal professional and expert in Indian law.
+# 🔹 Prompt 4 – Layman's Understanding
+LAYMAN_PROMPT = """You are a senior legal professional and expert in Indian law.
         Your task is to explain this PDF judgment in simple terms, as if explaining to a non-law student.
 
         CRITICAL: Focus on answering what the user specifically asked about, not giving a generic summary.
@@ -273,9 +538,8 @@ def get_legal_explanation(question, context_chunks, max_retries=3):
 
         Please provide a simple explanation that directly answers their specific question:"""
 
-    else:
-        # Default enhanced prompt for general questions
-        system_prompt = """You are a senior legal professional and expert in Indian law.
+# Default enhanced prompt for general questions
+DEFAULT_PROMPT = """You are a senior legal professional and expert in Indian law.
         Your task is to ANSWER THE USER'S SPECIFIC QUESTION about the provided legal document in very simple, everyday words that even a 10th grader can understand.
 
         CRITICAL: You must directly address the user's specific question, not give a generic summary.
@@ -307,21 +571,149 @@ def get_legal_explanation(question, context_chunks, max_retries=3):
 
         Please provide a clear, structured answer to the user's specific question:"""
 
-    prompt = system_prompt.format(context=context, question=question)
+PROMPT_TEMPLATES = {
+    "structured": STRUCTURED_PROMPT,
+    "layman": LAYMAN_PROMPT,
+    "default": DEFAULT_PROMPT,
+}
+
+# question phrases that select the structured summary / layman prompts
+STRUCTURED_KW = frozenset({
+    'structured summary', 'summary with sections', 'give a structured summary',
+    'case background', 'high court', 'supreme court', 'why it matters'
+})
+LAYMAN_KW = frozenset({
+    'explain in simple terms', 'layman', 'non-law student', 'simple words',
+    'easy explanation', 'plain english', 'everyday language'
+})
+# one alternation over both keyword sets, longest phrases first
+_PROMPT_KW_RE = re.compile("|".join(
+    re.escape(keyword) for keyword in sorted(STRUCTURED_KW | LAYMAN_KW, key=len, reverse=True)
+))
+
+def detect_prompt_kind(question):
+    """
+    Pick the prompt template for a question with a single regex scan over all keywords.
+    A structured-summary keyword anywhere wins over a layman keyword.
+    """
+    kind = "default"
+    for match in _PROMPT_KW_RE.finditer(question.lower()):
+        if match.group() in STRUCTURED_KW:
+            return "structured"
+        kind = "layman"
+    return kind
+
+# -------- Gemini answer cache ----------
+_gemini_cache = OrderedDict()
+_gemini_cache_lock = threading.Lock()
+_gemini_cache_stats = {"hits": 0, "misses": 0}
+
+def gemini_cache_key(prompt):
+    """Hash the fully rendered prompt (template + context + question)."""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def gemini_cache_get(key):
+    """Return a cached explanation for key if present and not expired, else None."""
+    with _gemini_cache_lock:
+        entry = _gemini_cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < GEMINI_CACHE_TTL:
+            _gemini_cache.move_to_end(key)
+            _gemini_cache_stats["hits"] += 1
+            return entry[1]
+        if entry is not None:
+            del _gemini_cache[key]
+        _gemini_cache_stats["misses"] += 1
+        return None
+
+def gemini_cache_put(key, result):
+    """Cache a successful explanation, evicting the least recently used entry when full."""
+    with _gemini_cache_lock:
+        _gemini_cache[key] = (time.monotonic(), result)
+        _gemini_cache.move_to_end(key)
+        if len(_gemini_cache) > GEMINI_CACHE_MAX_ENTRIES:
+            _gemini_cache.popitem(last=False)
+
+GEMINI_UNAVAILABLE_ERROR = "❌ AI service temporarily unavailable due to quota limits. Please try again later or use the search functionality to find relevant legal cases."
+NO_CONTEXT_ANSWER = "I can help explain legal concepts in simple terms, but I need some context from legal cases to provide accurate information. Please use the main search form first to find relevant cases, then ask me specific questions about them."
+
+def context_chunk_text(chunk):
+    """Text of a context chunk; search results sent by id are read from the corpus."""
+    case_id = chunk.get('id')
+    if case_id not in (None, ''):
+        try:
+            idx = int(case_id)
+        except (TypeError, ValueError):
+            idx = -1
+        # pyarrow accepts negative indices, so only ids of real cases are looked up
+        if 0 <= idx < len(get_case_names()):
+            return get_judgment_texts()[idx].as_py()
+    return chunk.get('full_text', chunk.get('preview', ''))
+
+def build_legal_prompt(question, context_chunks):
+    """Render the prompt template matching the question with the given context chunks."""
+    # Build context from chunks
+    context = "\n\n".join(
+        f"[Source: {chunk.get('case', 'Unknown Case')}] {context_chunk_text(chunk)[:1000]}"
+        for chunk in context_chunks
+    )
+
+    # Choose appropriate prompt based on question type
+    system_prompt = PROMPT_TEMPLATES[detect_prompt_kind(question)]
+
+    return system_prompt.format(context=context, question=question)
+
+def context_sources(context_chunks):
+    """Case names cited by the context chunks."""
+    return [chunk.get('case', 'Unknown Case') for chunk in context_chunks if chunk.get('case')]
+
+def gemini_error_message(error_str, attempts):
+    """Provide helpful error messages based on error type"""
+    if "quota" in error_str.lower() or "429" in error_str:
+        return "❌ QUOTA EXCEEDED: Your Gemini API free tier limit has been reached. Please upgrade to a paid plan or wait for the quota to reset. See: https://ai.google.dev/pricing"
+    elif "api_key" in error_str.lower() or "permission" in error_str.lower():
+        return "❌ API KEY ISSUE: Please check your Gemini API key in the .env file. Make sure it's valid and has the required permissions."
+    else:
+        return f"❌ AI service error after {attempts} attempt{'s' if attempts != 1 else ''}: {error_str}"
+
+async def get_legal_explanation(question, context_chunks, max_retries=3):
+    """
+    Get legal explanation from Gemini AI using retrieved context.
+    """
+    gemini_model = get_gemini_model()
+    if not gemini_model:
+        return {
+            "error": GEMINI_UNAVAILABLE_ERROR,
+            "answer": None,
+            "sources": []
+        }
+
+    # Check if we have context, if not provide a helpful response
+    if not context_chunks or len(context_chunks) == 0:
+        return {
+            "error": None,
+            "answer": NO_CONTEXT_ANSWER,
+            "sources": []
+        }
+
+    prompt = build_legal_prompt(question, context_chunks)
+
+    cache_key = gemini_cache_key(prompt)
+    cached = gemini_cache_get(cache_key)
+    if cached is not None:
+        return dict(cached)
 
     for attempt in range(max_retries):
         try:
-            response = gemini_model.generate_content(prompt)
+            response = await asyncio.to_thread(gemini_model.generate_content, prompt)
 
             if response and response.text:
-                # Extract sources from context
-                sources = [chunk.get('case', 'Unknown Case') for chunk in context_chunks if chunk.get('case')]
-
-                return {
+                result = {
                     "answer": response.text.strip(),
-                    "sources": sources,
+                    "sources": context_sources(context_chunks),
                     "error": None
                 }
+                gemini_cache_put(cache_key, result)
+                return dict(result)
             else:
                 return {
                     "error": "No response generated from AI model",
@@ -332,25 +724,11 @@ def get_legal_explanation(question, context_chunks, max_retries=3):
         except Exception as e:
             error_str = str(e)
             if attempt == max_retries - 1:
-                # Provide helpful error messages based on error type
-                if "quota" in error_str.lower() or "429" in error_str:
-                    return {
-                        "error": "❌ QUOTA EXCEEDED: Your Gemini API free tier limit has been reached. Please upgrade to a paid plan or wait for the quota to reset. See: https://ai.google.dev/pricing",
-                        "answer": None,
-                        "sources": []
-                    }
-                elif "api_key" in error_str.lower() or "permission" in error_str.lower():
-                    return {
-                        "error": "❌ API KEY ISSUE: Please check your Gemini API key in the .env file. Make sure it's valid and has the required permissions.",
-                        "answer": None,
-                        "sources": []
-                    }
-                else:
-                    return {
-                        "error": f"❌ AI service error after {max_retries} attempts: {error_str}",
-                        "answer": None,
-                        "sources": []
-                    }
+                return {
+                    "error": gemini_error_message(error_str, max_retries),
+                    "answer": None,
+                    "sources": []
+                }
             continue
 
     return {
@@ -359,135 +737,202 @@ def get_legal_explanation(question, context_chunks, max_retries=3):
         "sources": []
     }
 
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+def stream_legal_explanation(question, context_chunks, max_retries=3):
+    """
+    Stream a legal explanation from Gemini as Server-Sent Events:
+    "chunk" events carry answer text as it arrives, then a final "done" event
+    with the sources, or an "error" event. Cached answers are sent as one chunk.
+    Failures are retried only until the first chunk has been sent.
+    """
+    gemini_model = get_gemini_model()
+    if not gemini_model:
+        yield sse_event("error", {"error": GEMINI_UNAVAILABLE_ERROR})
+        return
+
+    prompt = build_legal_prompt(question, context_chunks)
+    cache_key = gemini_cache_key(prompt)
+    cached = gemini_cache_get(cache_key)
+    if cached is not None:
+        yield sse_event("chunk", {"text": cached["answer"]})
+        yield sse_event("done", {"sources": cached["sources"]})
+        return
+
+    parts = []
+    for attempt in range(max_retries):
+        try:
+            for chunk in gemini_model.generate_content(prompt, stream=True):
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield sse_event("chunk", {"text": chunk.text})
+            break
+        except Exception as e:
+            if parts or attempt == max_retries - 1:
+                yield sse_event("error", {"error": gemini_error_message(str(e), attempt + 1)})
+                return
+
+    answer = "".join(parts).strip()
+    if not answer:
+        yield sse_event("error", {"error": "No response generated from AI model"})
+        return
+
+    sources = context_sources(context_chunks)
+    gemini_cache_put(cache_key, {"answer": answer, "sources": sources, "error": None})
+    yield sse_event("done", {"sources": sources})
+
 # -------- Routes ----------
 @app.route("/health", methods=["GET"])
 def health():
     """Health check endpoint that doesn't require ML models"""
     return jsonify({
         "status": "healthy",
-        "models_loaded": _models_loaded,
+        "models_loaded": models_loaded(),
         "message": "App is running. ML models load on-demand."
     })
 
-@app.route("/", methods=["GET", "POST"])
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    """Hit/miss counters for the Gemini answer cache and size of the semantic search cache"""
+    with _gemini_cache_lock:
+        hits = _gemini_cache_stats["hits"]
+        misses = _gemini_cache_stats["misses"]
+        gemini_entries = len(_gemini_cache)
+    lookups = hits + misses
+    return jsonify({
+        "gemini": {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": gemini_entries
+        },
+        "semantic_search": {
+            "entries": len(_cache_entries)
+        }
+    })
+
+@app.route("/", methods=["GET"])
 def index():
     # Prevent caching to ensure fresh page loads
-    if request.method == "GET":
-        response = make_response(render_template("index.html", results=None, category=None, original_document=None))
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-        return response
-
-    # Initialize variables - only set on POST requests
-    results = None
-    predicted_category = None
-    original_document = None
-
-    if request.method == "POST":
-        input_text = request.form.get("text_input", "").strip()
-
-        pdf_bytes = None
-        if not input_text:
-            # check for file in request
-            uploaded = request.files.get("file")
-            if not uploaded or uploaded.filename == "":
-                return "❌ No input provided (paste text or upload a PDF).", 400
-
-            # optional: strictly allow only .pdf extension
-            if not uploaded.filename.lower().endswith(".pdf"):
-                return "❌ Only PDF files are allowed.", 400
-
-            # read file into memory (no saving)
-            pdf_bytes = uploaded.read()
-            if not pdf_bytes:
-                return "❌ Uploaded file is empty.", 400
-
-            # extract text from bytes
-            input_text = read_pdf_from_bytes(pdf_bytes)
-
-            # Check if PDF extraction failed
-            if input_text.startswith("[ERROR]"):
-                return f"❌ PDF processing failed: {input_text}", 400
-
-        # Validate that we have input text
-        if not input_text:
-            return "❌ No text could be extracted from the input.", 400
-
-        # Check minimum word count
-        word_count = len(input_text.strip().split())
-        if word_count < 5:
-            return f"❌ Input text is too short. Please provide at least 5 words for meaningful analysis. Current: {word_count} words.", 400
-
-        # get text after "JUDGMENT" if present
-        start_index = input_text.find("JUDGMENT")
-        text = input_text[start_index:] if start_index != -1 else input_text
-
-        # Load models only when needed
+    response = make_response(render_template("index.html", results=None, category=None, original_document=None))
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate, max-age=0'
+    response.headers['Pragma'] = 'no-cache'
+    response.headers['Expires'] = '0'
+    response.headers['X-Accel-Expires'] = '0'
+    return response
+
+@app.route("/", methods=["POST"])
+async def search():
+    input_text = request.form.get("text_input", "").strip()
+
+    if not input_text:
+        # check for file in request
+        uploaded = request.files.get("file")
+        if not uploaded or uploaded.filename == "":
+            return "❌ No input provided (paste text or upload a PDF).", 400
+
+        # optional: strictly allow only .pdf extension
+        if not uploaded.filename.lower().endswith(".pdf"):
+            return "❌ Only PDF files are allowed.", 400
+
+        # hand the upload stream to the extractor (no saving to disk); it reads one
+        # bytes copy for PyMuPDF and releases it before the fallbacks and encoding
+        stream = uploaded.stream
+        if not stream.read(1):
+            return "❌ Uploaded file is empty.", 400
+        stream.seek(0)
+
+        # extract text from the stream
         try:
-            modellog = get_modellog()
-            model = get_model()
-            case_names = get_case_names()
-            embeddings = get_embeddings()
-            judgment_texts = get_judgment_texts()
+            input_text = await asyncio.to_thread(read_pdf_from_stream, stream)
+        finally:
+            # ********** PRIVACY: release the uploaded file as soon as text is extracted **********
+            uploaded.close()
+            del stream
+
+        # Check if PDF extraction failed
+        if input_text.startswith("[ERROR]"):
+            return f"❌ PDF processing failed: {input_text}", 400
+
+    # Validate that we have input text
+    if not input_text:
+        return "❌ No text could be extracted from the input.", 400
+
+    # Check minimum word count
+    word_count = len(input_text.strip().split())
+    if word_count < 5:
+        return f"❌ Input text is too short. Please provide at least 5 words for meaningful analysis. Current: {word_count} words.", 400
+
+    # get text after "JUDGMENT" if present
+    match = JUDGMENT_RE.search(input_text)
+    text = input_text[match.start():] if match else input_text
+    del input_text
+
+    # Load models only when needed
+    try:
+        if not models_loaded():
+            await asyncio.to_thread(load_models)
+        modellog = get_modellog()
+        model = get_model()
+        case_names = get_case_names()
+        embeddings = get_embeddings()
+        previews = get_previews()
+    except Exception as e:
+        return f"❌ Error in category prediction: {str(e)}", 500
+
+    # category prediction and semantic search (top 5) run concurrently on worker threads
+    prediction, search_result = await asyncio.gather(
+        asyncio.to_thread(modellog.predict, [text]),
+        asyncio.to_thread(semantic_search, model, embeddings, text),
+        return_exceptions=True
+    )
+    if isinstance(prediction, Exception):
+        return f"❌ Error in category prediction: {str(prediction)}", 500
+    if isinstance(search_result, Exception):
+        return f"❌ Error in semantic search: {str(search_result)}", 500
+
+    predicted_category = prediction[0]
+    top_results, top_scores = search_result
+
+    results = []
+    for idx, score in zip(top_results, top_scores):
+        # full judgment text is fetched on demand from /case/<id>
+        results.append({
+            "id": int(idx),
+            "case": case_names[idx],
+            "score": float(score),
+            "rank": len(results) + 1,
+            "preview": previews[int(idx)].as_py()
+        })
 
-            predicted_category = modellog.predict([text])[0]
-        except Exception as e:
-            return f"❌ Error in category prediction: {str(e)}", 500
+    # The original document content is passed to the page for chatbot use
+    print(f"DEBUG: POST request - results: {len(results)}, category: {predicted_category}")
+    return render_template("index.html", results=results, category=predicted_category, original_document=text)
 
-        # semantic search - top 5
-        try:
-            query_embedding = model.encode(text, convert_to_tensor=True)
-            cos_scores = util.cos_sim(query_embedding, embeddings)[0]
-            top_results = np.argsort(-cos_scores)[:5]
-        except Exception as e:
-            return f"❌ Error in semantic search: {str(e)}", 500
-
-        results = []
-        for idx in top_results:
-            results.append({
-                "case": case_names[idx],
-                "score": float(cos_scores[idx]),
-                "rank": len(results) + 1,
-                "preview": judgment_texts[idx][:500],
-                "full_text": judgment_texts[idx]
-            })
+@app.route("/case/<int:idx>", methods=["GET"])
+def case_detail(idx):
+    """Full judgment text of one case, loaded on demand by the results page"""
+    try:
+        case_names = get_case_names()
+        judgment_texts = get_judgment_texts()
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Error loading cases: {str(e)}"}), 500
 
-        # Store the original document content for chatbot use BEFORE cleanup
-        original_document = text if 'text' in locals() else (input_text if 'input_text' in locals() else None)
+    if idx >= len(case_names):
+        return jsonify({"success": False, "error": "Case not found"}), 404
 
-        # ********** PRIVACY: clean up large objects ASAP **********
-        try:
-            # remove sensitive text / bytes references
-            del input_text
-            del text
-            # Clean up PDF bytes if they exist
-            if 'pdf_bytes' in globals() or 'pdf_bytes' in locals():
-                if 'pdf_bytes' in locals():
-                    del pdf_bytes
-                elif 'pdf_bytes' in globals():
-                    del globals()['pdf_bytes']
-            gc.collect()
-        except Exception:
-            pass
-
-    # Handle GET requests (page reloads) - return clean page
-    if request.method == "GET":
-        print(f"DEBUG: GET request - returning clean page")
-        response = make_response(render_template("index.html", results=None, category=None, original_document=None))
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate, max-age=0'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-        response.headers['X-Accel-Expires'] = '0'
-        return response
-
-    # Handle POST requests (form submissions) - return with results
-    print(f"DEBUG: POST request - results: {results is not None}, category: {predicted_category}, original_doc: {original_document is not None}")
-    return render_template("index.html", results=results, category=predicted_category, original_document=original_document)
+    return jsonify({
+        "success": True,
+        "id": idx,
+        "case": case_names[idx],
+        "full_text": judgment_texts[idx].as_py()
+    })
 
 # -------- Test API Key Route ----------
 @app.route("/test-api", methods=["GET"])
-def test_api():
+async def test_api():
     """Test endpoint to check if Gemini API key is working"""
     gemini_model = get_gemini_model()
     api_key = os.getenv('GEMINI_API_KEY')
@@ -502,7 +947,7 @@ def test_api():
 
     try:
         # Test with a simple request using the same model
-        response = gemini_model.generate_content("Hello, can you respond with 'API test successful'?")
+        response = await asyncio.to_thread(gemini_model.generate_content, "Hello, can you respond with 'API test successful'?")
         if response and response.text:
             return jsonify({
                 "success": True,
@@ -522,10 +967,11 @@ def test_api():
 
 # -------- Chatbot Route ----------
 @app.route("/chat", methods=["POST"])
-def chat():
+async def chat():
     """
     Handle chatbot questions about legal cases.
-    Expects JSON: {"question": "user question", "context": [list of case chunks]}
+    Expects JSON: {"question": "user question", "context": [list of case chunks], "stream": optional bool}
+    With "stream": true the answer is sent as Server-Sent Events (see stream_legal_explanation).
     """
     try:
         data = request.get_json()
@@ -561,8 +1007,15 @@ def chat():
                 print(f"DEBUG: Returning general response: {response_data}")  # Debug log
                 return jsonify(response_data)
 
+        if data.get('stream'):
+            return Response(
+                stream_with_context(stream_legal_explanation(question, context_chunks)),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
+
         # Get legal explanation from Gemini
-        result = get_legal_explanation(question, context_chunks)
+        result = await get_legal_explanation(question, context_chunks)
 
         if result['error']:
             return jsonify({"success": False, "error": result['error']}), 500